@@ -6,86 +6,116 @@ Lume an E-Reader for Raspberry Pi Zero 2W with E-ink Display
 import RPi.GPIO as GPIO
 import time
 import os
+import mmap
 import json
 import logging
+import hashlib
+import functools
 from PIL import Image, ImageDraw, ImageFont
 import threading
 from pathlib import Path
 import sys
 import fitz  # PyMuPDF
 from ebooklib import epub
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 
-class BookReader:
-    def display_page(self): pass
-    def next_page(self): pass
-    def prev_page(self): pass
+CACHE_DIR = Path('/home/pi/.cache/lume')
+# Bump whenever pagination or text extraction changes so stale caches are ignored
+PAGE_CACHE_VERSION = 3
+# Pages kept pre-rendered behind and ahead of the current page
+PRERENDER_BEHIND = 1
+PRERENDER_AHEAD = 4
 
 
-class TextBookReader(BookReader):
-    def __init__(self, file_path, display):
-        self.file_path = file_path
-        self.display = display
-        self.current_page = 0
-        self.pages = []
-        self.chars_per_line = 80
-        self.lines_per_page = 20
-        self.load_book()
+def page_cache_key(file_path, chars_per_line, lines_per_page):
+    # One entry per book (named by its path); the stamp records what the pages were built from
+    stat = os.stat(file_path)
+    cache_path = CACHE_DIR / f"{hashlib.sha1(str(file_path).encode()).hexdigest()}.json"
+    stamp = f"{PAGE_CACHE_VERSION}:{stat.st_mtime_ns}:{chars_per_line}:{lines_per_page}"
+    return cache_path, stamp
 
-    def load_book(self):
-        try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            lines = content.split('\n')
-            current = []
-            for line in lines:
-                while len(line) > self.chars_per_line:
-                    current.append(line[:self.chars_per_line])
-                    line = line[self.chars_per_line:]
-                current.append(line)
-                if len(current) >= self.lines_per_page:
-                    self.pages.append('\n'.join(current))
-                    current = []
-            if current:
-                self.pages.append('\n'.join(current))
-        except Exception as e:
-            logging.error(f"Error loading TXT: {e}")
-            self.pages = [f"Error loading book: {e}"]
 
-    def display_page(self):
-        if not self.pages: return
-        self.display.buffer = Image.new('1', (self.display.WIDTH, self.display.HEIGHT), 1)
-        y = 20
-        for line in self.pages[self.current_page].split('\n'):
-            self.display.draw_text(line, 10, y)
-            y += 20
-        self.display.draw_text(f"Page {self.current_page+1}/{len(self.pages)}", 10, self.display.HEIGHT - 25)
-        self.display.display_image()
+def load_cached_pages(cache_path, stamp):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('stamp') != stamp:
+        return None
+    return cached.get('pages')
 
-    def next_page(self):
-        if self.current_page < len(self.pages) - 1:
-            self.current_page += 1
-            self.display_page()
 
-    def prev_page(self):
-        if self.current_page > 0:
-            self.current_page -= 1
-            self.display_page()
+def save_cached_pages(cache_path, stamp, pages):
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({'stamp': stamp, 'pages': pages}, f)
+    except OSError as e:
+        logging.warning(f"Could not cache pages: {e}")
 
 
-class PDFBookReader(BookReader):
+def wrap_line(line, width):
+    # Break at the last space that fits, or hard-break words longer than a line
+    lines, start, end = [], 0, len(line)
+    while end - start > width:
+        cut = line.rfind(' ', start, start + width + 1)
+        if cut <= start:
+            lines.append(line[start:start + width])
+            start += width
+        else:
+            lines.append(line[start:cut])
+            start = cut + 1
+    if start < end or not lines:
+        lines.append(line[start:])
+    return lines
+
+
+class GlyphCache:
+    """1-bit glyph bitmaps for a font, so text can be drawn by pasting masks."""
+
+    def __init__(self, font):
+        self.font = font
+        self.glyphs = {ch: self.render_glyph(ch) for ch in map(chr, range(32, 127))}
+
+    def render_glyph(self, ch):
+        left, top, right, bottom = self.font.getbbox(ch, mode='1')
+        mask = None
+        if right > left and bottom > top:
+            mask = Image.new('1', (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), ch, font=self.font, fill=1)
+        return mask, left, top, self.font.getlength(ch, mode='1')
+
+    def draw_text(self, image, text, x, y):
+        for ch in text:
+            glyph = self.glyphs.get(ch)
+            if glyph is None:
+                glyph = self.glyphs[ch] = self.render_glyph(ch)
+            mask, left, top, advance = glyph
+            if mask is not None:
+                image.paste(0, (round(x) + left, y + top), mask)
+            x += advance
+
+
+@functools.lru_cache(maxsize=None)
+def glyph_cache_for(font):
+    return GlyphCache(font)
+
+
+class BookReader:
     def __init__(self, file_path, display):
+        self.file_path = file_path
         self.display = display
-        self.doc = fitz.open(file_path)
         self.current_page = 0
-        self.total_pages = len(self.doc)
+        self.stop_event = threading.Event()
 
-    def display_page(self):
-        page = self.doc.load_page(self.current_page)
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False)
-        image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        bw_image = image.convert("1").resize((self.display.WIDTH, self.display.HEIGHT))
-        self.display.display_image(bw_image)
+    def close(self):
+        self.stop_event.set()
+
+    @property
+    def total_pages(self): return 0
+
+    def display_page(self): pass
 
     def next_page(self):
         if self.current_page < self.total_pages - 1:
@@ -98,54 +128,188 @@ class PDFBookReader(BookReader):
             self.display_page()
 
 
-class EPUBBookReader(BookReader):
+class TextLayoutReader(BookReader):
+    """Base for readers that paginate plain text and draw it with the glyph cache."""
+
     def __init__(self, file_path, display):
-        self.display = display
-        self.book = epub.read_epub(file_path)
+        super().__init__(file_path, display)
         self.pages = []
-        self.current_page = 0
-        self.parse_book()
+        self.chars_per_line = 80
+        self.lines_per_page = 20
+        self.prerender_wanted = threading.Event()
 
-    def parse_book(self):
-        for item in self.book.get_items():
-            if item.get_type() == epub.ITEM_DOCUMENT:
-                soup = BeautifulSoup(item.get_body_content(), 'html.parser')
-                text = soup.get_text()
-                self.pages.extend(self.paginate(text))
+    def close(self):
+        super().close()
+        self.prerender_wanted.set()
+
+    @property
+    def total_pages(self):
+        return len(self.pages)
 
-    def paginate(self, content):
-        lines = content.split('\n')
+    def paginate(self, lines):
         pages, current = [], []
         for line in lines:
-            wrapped = [line[i:i+80] for i in range(0, len(line), 80)]
-            for wline in wrapped:
-                current.append(wline)
-                if len(current) == 20:
-                    pages.append('\n'.join(current))
-                    current = []
+            current.extend(wrap_line(line, self.chars_per_line))
+            while len(current) >= self.lines_per_page:
+                pages.append('\n'.join(current[:self.lines_per_page]))
+                current = current[self.lines_per_page:]
         if current:
             pages.append('\n'.join(current))
         return pages
 
     def display_page(self):
         if not self.pages: return
-        self.display.buffer = Image.new('1', (self.display.WIDTH, self.display.HEIGHT), 1)
+        self.load_page(self.current_page, self.page_buffer())
+        # Refill the prerender window while the panel refreshes
+        self.prerender_wanted.set()
+        self.display.display_image()
+
+    def start_prerender(self):
+        # Pages are kept packed (tobytes) since a '1' image holds a byte per pixel
+        self.rendered_pages = {}
+        self.render_lock = threading.Lock()
+        threading.Thread(target=self._prerender, daemon=True).start()
+
+    def _prerender(self):
+        scratch = Image.new('1', (self.display.WIDTH, self.display.HEIGHT), 1)
+        while not self.stop_event.is_set():
+            self.prerender_wanted.wait()
+            self.prerender_wanted.clear()
+            window = range(max(self.current_page - PRERENDER_BEHIND, 0),
+                           min(self.current_page + PRERENDER_AHEAD + 1, self.total_pages))
+            for index in list(self.rendered_pages):
+                if index not in window:
+                    del self.rendered_pages[index]
+            for index in window:
+                if self.stop_event.is_set() or self.prerender_wanted.is_set():
+                    break
+                if index in self.rendered_pages:
+                    continue
+                with self.render_lock:
+                    self.render_page(index, scratch)
+                    self.rendered_pages[index] = scratch.tobytes()
+
+    def render_page(self, index, image):
+        ImageDraw.Draw(image).rectangle((0, 0, self.display.WIDTH, self.display.HEIGHT), fill=1)
+        glyphs = glyph_cache_for(self.display.font)
         y = 20
-        for line in self.pages[self.current_page].split('\n'):
-            self.display.draw_text(line, 10, y)
+        for line in self.pages[index].split('\n'):
+            glyphs.draw_text(image, line, 10, y)
             y += 20
-        self.display.draw_text(f"Page {self.current_page+1}/{len(self.pages)}", 10, self.display.HEIGHT - 25)
-        self.display.display_image()
+        glyphs.draw_text(image, f"Page {index+1}/{self.total_pages}", 10, self.display.HEIGHT - 25)
 
-    def next_page(self):
-        if self.current_page < len(self.pages) - 1:
-            self.current_page += 1
-            self.display_page()
+    def page_buffer(self):
+        # Reuse the display's buffer across page flips instead of allocating a new image
+        buffer = getattr(self.display, 'buffer', None)
+        if buffer is None or buffer.mode != '1' or buffer.size != (self.display.WIDTH, self.display.HEIGHT):
+            buffer = self.display.buffer = Image.new('1', (self.display.WIDTH, self.display.HEIGHT), 1)
+        return buffer
 
-    def prev_page(self):
-        if self.current_page > 0:
-            self.current_page -= 1
-            self.display_page()
+    def load_page(self, index, image):
+        packed = self.rendered_pages.get(index)
+        if packed is not None:
+            image.frombytes(packed)
+            return
+        with self.render_lock:
+            self.render_page(index, image)
+
+
+class TextBookReader(TextLayoutReader):
+    def __init__(self, file_path, display):
+        super().__init__(file_path, display)
+        self.load_book()
+        self.start_prerender()
+
+    def load_book(self):
+        try:
+            cache_path, stamp = page_cache_key(self.file_path, self.chars_per_line, self.lines_per_page)
+            cached = load_cached_pages(cache_path, stamp)
+            if cached is not None:
+                self.pages = cached
+                return
+            self.pages = self.paginate(self.read_lines())
+            save_cached_pages(cache_path, stamp, self.pages)
+        except Exception as e:
+            logging.error(f"Error loading TXT: {e}")
+            self.pages = [f"Error loading book: {e}"]
+
+    def read_lines(self):
+        # Stream lines from a read-only mapping rather than holding a second copy of the file
+        with open(self.file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap rejects empty files; still give the book one blank page
+                yield ''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for raw in iter(mm.readline, b''):
+                    yield raw.decode('utf-8', 'ignore').rstrip('\r\n')
+
+
+class PDFBookReader(BookReader):
+    def __init__(self, file_path, display):
+        super().__init__(file_path, display)
+        self.doc = fitz.open(file_path)
+        self.render_lock = threading.Lock()
+        self._render_cached = functools.lru_cache(maxsize=8)(self.rasterize_page)
+
+    def render(self, index):
+        # PyMuPDF documents are not thread-safe, so the prefetch and display paths take turns
+        with self.render_lock:
+            return self._render_cached(index)
+
+    @property
+    def total_pages(self):
+        return len(self.doc)
+
+    def rasterize_page(self, index):
+        page = self.doc.load_page(index)
+        # Render straight to panel resolution in grayscale instead of upscaling and resizing
+        zoom = min(self.display.WIDTH / page.rect.width, self.display.HEIGHT / page.rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+        image = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+        bw_image = image.convert("1", dither=Image.FLOYDSTEINBERG)
+        if bw_image.size != (self.display.WIDTH, self.display.HEIGHT):
+            framed = Image.new('1', (self.display.WIDTH, self.display.HEIGHT), 1)
+            framed.paste(bw_image, ((self.display.WIDTH - pix.width) // 2, (self.display.HEIGHT - pix.height) // 2))
+            bw_image = framed
+        return bw_image
+
+    def display_page(self):
+        image = self.render(self.current_page)
+        if self.current_page + 1 < self.total_pages:
+            threading.Thread(target=self.render, args=(self.current_page + 1,), daemon=True).start()
+        self.display.display_image(image)
+
+
+class EPUBBookReader(TextLayoutReader):
+    def __init__(self, file_path, display):
+        super().__init__(file_path, display)
+        self.parse_book()
+        self.start_prerender()
+
+    def parse_book(self):
+        cache_path, stamp = page_cache_key(self.file_path, self.chars_per_line, self.lines_per_page)
+        cached = load_cached_pages(cache_path, stamp)
+        if cached is not None:
+            self.pages = cached
+            return
+        self.book = epub.read_epub(self.file_path)
+        for item in self.book.get_items():
+            if item.get_type() == epub.ITEM_DOCUMENT:
+                # get_body_content() is UTF-8 with no charset declaration; decode before lxml guesses Latin-1
+                body = item.get_body_content().decode('utf-8', 'ignore')
+                if not body.strip():
+                    continue
+                try:
+                    tree = lxml_html.fromstring(body)
+                except etree.ParserError as e:
+                    logging.warning(f"Skipping EPUB item {item.get_name()}: {e}")
+                    continue
+                for element in tree.xpath('//script | //style'):
+                    element.drop_tree()
+                text = tree.text_content()
+                self.pages.extend(self.paginate(line for line in text.split('\n') if line.strip()))
+        save_cached_pages(cache_path, stamp, self.pages)
 
 
 
@@ -156,15 +320,19 @@ class EPUBBookReader(BookReader):
         try:
             ext = file_path.suffix.lower()
             if ext == '.txt':
-                self.current_book = TextBookReader(file_path, self.display)
+                book = TextBookReader(file_path, self.display)
             elif ext == '.pdf':
-                self.current_book = PDFBookReader(file_path, self.display)
+                book = PDFBookReader(file_path, self.display)
             elif ext == '.epub':
-                self.current_book = EPUBBookReader(file_path, self.display)
+                book = EPUBBookReader(file_path, self.display)
             else:
                 logging.warning(f"Unsupported format: {ext}")
                 return
 
+            if self.current_book is not None:
+                self.current_book.close()
+            self.current_book = book
+
             if str(file_path) == self.settings.get('last_book'):
                 self.current_book.current_page = self.settings.get('last_page', 0)
 